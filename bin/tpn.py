@@ -7,7 +7,7 @@ def join_path(*args):
     return os.path.abspath(os.path.normpath(os.path.join(*args)))
 
 try:
-    from tpn.cli import main
+    from tpn.server import run_client
 except ImportError:
     path = os.path.abspath(__file__)
     if os.path.islink(path):
@@ -19,9 +19,16 @@ except ImportError:
         libdir = join_path(path, '../../lib')
         sys.path.insert(0, libdir)
 
-    from tpn.cli import main
+    from tpn.server import run_client
 
 if __name__ == '__main__':
+    # Hand the command off to a running `tpn serve` instance if there is one;
+    # otherwise, fall back to importing and running the CLI in-process.
+    rc = run_client(sys.argv[1:])
+    if rc is not None:
+        sys.exit(rc)
+
+    from tpn.cli import main
     main()
 
 # vi:set ts=8 sw=4 sts=4 expandtab tw=78 syntax=python:
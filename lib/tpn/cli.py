@@ -4,11 +4,14 @@
 from __future__ import print_function
 
 import os
-import re
 import sys
+import json
+import inspect
 import optparse
+import tempfile
 import textwrap
 import importlib
+import importlib.util
 
 from collections import (
     OrderedDict,
@@ -33,6 +36,10 @@ from .command import (
     ClashingCommandNames,
 )
 
+from .path import (
+    join_path,
+)
+
 from .util import (
     iterable,
     ensure_unique,
@@ -44,6 +51,11 @@ from .util import (
     DecayDict,
 )
 
+from .scheduler import (
+    TASK_STARTED,
+    TASK_FINISHED,
+)
+
 from .invariant import (
     Invariant,
 )
@@ -52,6 +64,9 @@ from .invariant import (
 #===============================================================================
 INTERACTIVE = False
 
+# Bump this whenever the layout of the persisted command index changes.
+COMMAND_INDEX_VERSION = 2
+
 #===============================================================================
 # Constants
 #===============================================================================
@@ -221,6 +236,157 @@ class CommandLine:
         self.command.options = self.options
         self.command.start()
 
+#===============================================================================
+# Command Index
+#===============================================================================
+class CommandIndex(object):
+    """
+    Persistent index of the Command subclasses defined in a given namespace's
+    ``<namespace>.commands`` module.
+
+    Each entry records the command's class name, name and shortname.  The
+    index is saved as JSON under the data directory, along with the path,
+    mtime and size of the source file of the commands module and of every
+    module defining one of the commands' base classes, and the tpn version.
+    It's considered valid for as long as all of those match, which allows
+    the CLI to list and dispatch commands without importing every commands
+    module on every invocation.
+    """
+    def __init__(self, namespace, index_dir=None):
+        self.namespace = namespace
+        self.module_name = '%s.commands' % namespace
+        self.index_dir = index_dir
+        self.module = None
+        self.entries = None
+        self.dependencies = None
+
+    @property
+    def path(self):
+        if not self.index_dir:
+            return
+        return join_path(self.index_dir, '%s.json' % self.namespace)
+
+    @staticmethod
+    def _file_stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        return [ path, st.st_mtime_ns, st.st_size ]
+
+    def _source_stat(self):
+        spec = importlib.util.find_spec(self.module_name)
+        if not spec or not spec.origin:
+            return
+        return self._file_stat(spec.origin)
+
+    def _load(self, stat):
+        path = self.path
+        if not path or not stat:
+            return
+        try:
+            with open(path, 'r') as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+
+        if index.get('version') != COMMAND_INDEX_VERSION:
+            return
+        if index.get('tpn_version') != tpn.__version__:
+            return
+        dependencies = index.get('dependencies') or []
+        if not dependencies or dependencies[0] != stat:
+            return
+        for dependency in dependencies[1:]:
+            if self._file_stat(dependency[0]) != dependency:
+                return
+        return index['commands']
+
+    def _save(self, stat):
+        path = self.path
+        if not path or not stat:
+            return
+        index = {
+            'version': COMMAND_INDEX_VERSION,
+            'tpn_version': tpn.__version__,
+            'namespace': self.namespace,
+            'dependencies': [ stat ] + self.dependencies,
+            'commands': self.entries,
+        }
+        try:
+            (fd, tmp) = tempfile.mkstemp(dir=self.index_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(index, f)
+            os.replace(tmp, path)
+        except (IOError, OSError):
+            pass
+
+    def _get_base_class_sources(self, classes):
+        """
+        Return the stats of the source files of the modules (other than the
+        commands module itself) that define the bases of ``classes``.
+        """
+        modules = set()
+        for cls in classes:
+            for base in cls.__mro__[1:]:
+                if base.__module__ not in (self.module_name, 'builtins'):
+                    modules.add(base.__module__)
+
+        stats = []
+        for name in sorted(modules):
+            path = getattr(sys.modules.get(name), '__file__', None)
+            stat = self._file_stat(path) if path else None
+            if stat:
+                stats.append(stat)
+        return stats
+
+    def _build(self):
+        module = self.import_module()
+        entries = list()
+        classes = list()
+        for (name, attr) in vars(module).items():
+            if name[0] == '_' or not inspect.isclass(attr):
+                continue
+            if attr.__module__ != module.__name__ or attr.__name__ != name:
+                continue
+            if attr == Command or not issubclass(attr, Command):
+                continue
+
+            (command_name, shortname) = attr.get_names()
+            entries.append({
+                'classname': name,
+                'name': command_name,
+                'shortname': shortname,
+            })
+            classes.append(attr)
+        self.dependencies = self._get_base_class_sources(classes)
+        return entries
+
+    def import_module(self):
+        if not self.module:
+            self.module = importlib.import_module(self.module_name)
+        return self.module
+
+    def load(self):
+        """
+        Return the list of command entries for this namespace, rebuilding
+        (and persisting) the index if it's missing or stale.
+        """
+        if self.entries is not None:
+            return self.entries
+
+        stat = self._source_stat()
+        entries = self._load(stat)
+        if entries is None:
+            self.entries = self._build()
+            self._save(stat)
+        else:
+            self.entries = entries
+        return self.entries
+
+    def get_command_class(self, classname):
+        return getattr(self.import_module(), classname)
+
 #===============================================================================
 # CLI Class
 #===============================================================================
@@ -244,6 +410,7 @@ class CLI(object):
         self.module_names = k.module_names or []
         self.args_queue = k.get('args_queue', None)
         self.feedback_queue = k.get('feedback_queue', None)
+        self.max_tasks = k.get('max_tasks', None)
         k.assert_empty(self)
         self.returncode = 0
         self.commandline = None
@@ -269,7 +436,7 @@ class CLI(object):
         self._commands_by_name = dict()
         self._commands_by_shortname = dict()
 
-        self._import_command_and_config_modules()
+        self._load_command_indexes()
         self._load_commands()
 
         if not self.args_queue:
@@ -283,81 +450,129 @@ class CLI(object):
             self._process_commandline()
             return
 
-        from Queue import Empty
+        # Worker mode (see tpn.scheduler): pull (task_id, args) tuples off
+        # the queue until we get a None sentinel (or have run max_tasks),
+        # reporting the start and outcome of each task on feedback_queue.
+        pid = os.getpid()
         cmdlines = {}
+        count = 0
         while True:
-            try:
-                args = self.args_queue.get_nowait()
-            except Empty:
+            task = self.args_queue.get()
+            if task is None:
                 break
 
-            cmdline = args.pop(0).lower()
-            if cmdline not in cmdlines:
-                cmdlines[cmdline] = self._find_commandline(cmdline)
-            cl = cmdlines[cmdline]
+            (task_id, args) = task
+            self._feedback(TASK_STARTED, pid, task_id)
+            (rc, error) = self._run_task(cmdlines, list(args))
+            self._feedback(TASK_FINISHED, pid, task_id, rc, error)
+
+            count += 1
+            if self.max_tasks and count >= self.max_tasks:
+                break
+
+    def _feedback(self, *message):
+        if self.feedback_queue is not None:
+            self.feedback_queue.put(message)
+
+    def _run_task(self, cmdlines, args):
+        """
+        Run a single sub-command on behalf of the scheduler.  Returns a
+        tuple of (returncode, error message or None).
+        """
+        cmdline = args.pop(0).lower()
+        if cmdline not in cmdlines:
+            cmdlines[cmdline] = self._find_commandline(cmdline)
+        cl = cmdlines[cmdline]
+        if not cl:
+            error = self.__unknown_subcommand__ % cmdline
+            self._error(error)
+            return (1, error)
+
+        try:
             cl.run(args)
-            self.args_queue.task_done()
+        except (CommandError, Invariant) as err:
+            self._commandline_error(cl, str(err))
+            return (1, str(err))
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return (e.code or 0, None)
+            return (1, str(e.code))
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            return (1, '%s: %s' % (e.__class__.__name__, str(e)))
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+        return (0, None)
+
+    def _get_command_index_dir(self):
+        try:
+            index_dir = join_path(Config.data_dir, 'command-index')
+            if not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+        except (IOError, OSError):
+            index_dir = None
+        return index_dir
+
+    def _load_command_indexes(self):
+        index_dir = self._get_command_index_dir()
+        self.indexes = OrderedDict(
+            (namespace, CommandIndex(namespace, index_dir))
+                for namespace in self.module_names
+        )
 
-    def _import_command_and_config_modules(self):
-        for namespace in self.module_names:
-            for suffix in ('commands', 'config'):
-                name = '.'.join((namespace, suffix))
-                store = getattr(self.modules, suffix)
-                store[namespace] = importlib.import_module(name)
+    def _import_config_module(self, namespace):
+        store = self.modules.config
+        if namespace not in store:
+            name = '.'.join((namespace, 'config'))
+            store[namespace] = importlib.import_module(name)
+        return store[namespace]
 
     def _find_command_subclasses(self):
         seen = dict()
-        pattern = re.compile(r'^class ([^\s]+)\(.*', re.M)
         subclasses = list()
-        for (namespace, module) in self.modules.commands.items():
-            path = module.__file__
-            if path[-1] == 'c':
-                path = path[:-1]
-
-            with open(path, 'r') as f:
-                matches = pattern.findall(f.read())
-
-            for name in [ n for n in matches if n[0] != '_' ]:
-                attr = getattr(module, name)
-                if attr == Command or not issubclass(attr, Command):
-                    continue
-
+        for (namespace, index) in self.indexes.items():
+            for entry in index.load():
+                name = entry['classname']
                 if name in seen:
                     args = (name, seen[name], namespace)
                     raise ClashingCommandNames(*args)
 
                 seen[name] = namespace
-                subclasses.append((namespace, name, attr))
+                subclasses.append((namespace, name, entry))
 
         return subclasses
 
     def _load_commands(self):
         subclasses = [
-            sc for sc in sorted(self._find_command_subclasses())
+            sc for sc in sorted(
+                self._find_command_subclasses(),
+                key=lambda sc: sc[:2],
+            )
         ]
 
-        for (namespace, command_name, command_class) in subclasses:
-            if command_name in self._commands_by_name:
+        for (namespace, command_name, entry) in subclasses:
+            name = entry['name']
+            shortname = entry['shortname']
+            if name in self._commands_by_name:
                 continue
 
-            config_module = self.modules.config[namespace]
-            config_class = getattr(config_module, 'Config')
-            cl = CommandLine(self.program_name, command_class, config_class)
-
-            helpstr = self._helpstr(cl.name)
+            helpstr = self._helpstr(name)
 
-            if cl.shortname:
-                if cl.shortname in self._commands_by_shortname:
+            if shortname:
+                if shortname in self._commands_by_shortname:
                     continue
-                self._commands_by_shortname[cl.shortname] = cl
+                self._commands_by_shortname[shortname] = name
                 if '[n]@' in helpstr:
                     prefix = '[n]@'
                 else:
                     prefix = ''
-                helpstr += ' (%s%s)' % (prefix, cl.shortname)
+                helpstr += ' (%s%s)' % (prefix, shortname)
 
             self._help += helpstr
-            self._commands_by_name[cl.name] = cl
+            self._commands_by_name[name] = (namespace, command_name)
 
         # Add a fake version command so that it'll appear in the list of
         # available commands.  (We intercept version requests during
@@ -365,6 +580,19 @@ class CLI(object):
         self._help += self._helpstr('version')
         self._commands_by_name['version'] = None
 
+        # Likewise for serve, which is intercepted as a CLI method.
+        if os.name == 'posix':
+            self._help += self._helpstr('serve')
+
+    def _create_commandline(self, namespace, command_name):
+        index = self.indexes[namespace]
+        command_class = index.get_command_class(command_name)
+        self.modules.commands[namespace] = index.module
+
+        config_module = self._import_config_module(namespace)
+        config_class = getattr(config_module, 'Config')
+        return CommandLine(self.program_name, command_class, config_class)
+
     def _helpstr(self, name):
         i = 12
         if name.startswith('multiprocess'):
@@ -409,8 +637,14 @@ class CLI(object):
         self._commands_by_name['version'] = None
 
     def _find_commandline(self, cmdline):
-        return self._commands_by_name.get(cmdline,
-               self._commands_by_shortname.get(cmdline))
+        name = cmdline
+        if name not in self._commands_by_name:
+            name = self._commands_by_shortname.get(cmdline)
+
+        cl = self._commands_by_name.get(name)
+        if isinstance(cl, tuple):
+            cl = self._commands_by_name[name] = self._create_commandline(*cl)
+        return cl
 
     def _process_commandline(self):
         args = self.args
@@ -418,8 +652,8 @@ class CLI(object):
 
         if cmdline and cmdline[0] != '_':
             if '-' not in cmdline and hasattr(self, cmdline):
-                getattr(self, cmdline)(args)
-                return self._exit(0)
+                rc = getattr(self, cmdline)(args)
+                return self._exit(rc or 0)
             elif cmdline in ('-v', '-V', '--version'):
                 self.version()
             else:
@@ -439,6 +673,20 @@ class CLI(object):
                 ))
             )
 
+    def dispatch(self, args):
+        """
+        Run the command described by ``args`` using this (already loaded)
+        CLI instance, and return the resulting exit code.
+        """
+        self.returncode = 0
+        self.commandline = None
+        self.args = list(args)
+        if self.args:
+            self._process_commandline()
+        else:
+            self.help()
+        return self.returncode
+
     def _exit(self, code):
         self.returncode = code
 
@@ -465,6 +713,39 @@ class CLI(object):
         sys.stdout.write(add_linesep_if_missing(tpn.__version__))
         return self._exit(0)
 
+    def _warm_up(self):
+        """
+        Import every command module, create every CommandLine, and load the
+        configuration, such that subsequent dispatches don't have to.
+        """
+        for name in list(self._commands_by_name):
+            self._find_commandline(name)
+
+        config_module = self._import_config_module(self.module_names[-1])
+        config_class = getattr(config_module, 'Config')
+        try:
+            conf = config_class()
+            conf.load()
+        except ConfigObjectAlreadyCreated:
+            pass
+
+    def serve(self, args=None):
+        """
+        Run a warm-interpreter server that executes commands on behalf of
+        thin clients (see tpn.server).  Takes an optional socket path.
+        """
+        from .server import (
+            serve,
+            ServerError,
+        )
+        self._warm_up()
+        out = lambda s: sys.stderr.write(add_linesep_if_missing(s))
+        try:
+            serve(self, path=args[0] if args else None, out=out)
+        except ServerError as err:
+            self._error('error: serve failed: %s' % str(err))
+            return 1
+
     def help(self, args=None):
         if args:
             l = [ args.pop(0), '-h' ]
@@ -512,7 +793,8 @@ if __name__ == '__main__':
     # Multiprocessor support: prefix command_name with @.  The @ will be
     # removed, the command will be run, and then the command.result field
     # will be expected to be populated with a list of argument lists that
-    # will be pushed onto a multiprocessing joinable queue.
+    # will be run as sub-commands by a pool of worker processes (see
+    # tpn.scheduler).
 
     is_mp = False
     args = sys.argv[1:]
@@ -532,25 +814,16 @@ if __name__ == '__main__':
         sys.exit(cli.returncode)
 
     command = cli.commandline.command
-    results = command.results
+    results = getattr(command, 'results', None)
     if not results:
-        err("parallel command did not produce any results\n")
+        sys.stderr.write("error: parallel command did not produce any results\n")
         sys.exit(1)
 
-    from multiprocessing import (
-        cpu_count,
-        Process,
-        JoinableQueue,
-    )
-
-    args_queue = JoinableQueue(len(results))
-
-    for args in results:
-        args_queue.put(args[2:])
+    from multiprocessing import cpu_count
+    from tpn.scheduler import Scheduler
 
     # Grab the program_name and module_names from the first result args.
     (_, kwds) = extract_command_args_and_kwds(*results[0])
-    kwds['args_queue'] = args_queue
 
     nprocs = cpu_count()
     if parallelism_hint:
@@ -560,15 +833,14 @@ if __name__ == '__main__':
             sys.stderr.write(msg)
         nprocs = parallelism_hint
 
-    procs = []
-    for i in range(0, nprocs):
-        p = Process(target=run_mp, kwargs=kwds)
-        procs.append(p)
-        p.start()
-
-    sys.stdout.write("started %d processes\n" % len(procs))
-
-    args_queue.join()
+    scheduler = Scheduler(
+        [ args[2:] for args in results ],
+        kwds,
+        nprocs=nprocs,
+        retries=command._mp_retries_,
+        max_tasks_per_worker=command._mp_max_tasks_per_worker_,
+    )
+    sys.exit(0 if scheduler.run() else 1)
 
 def main():
     args = [ 'tpn', 'tpn' ] + sys.argv[1:]
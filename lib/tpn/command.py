@@ -179,6 +179,13 @@ class Command(ImplicitContextSensitiveObject):
     _shortname_ = None
     _description_ = None
 
+    # Used by the multiprocess (``@``) mode of ``python -m tpn.cli`` when this
+    # command produces sub-commands: the number of times a failed sub-command
+    # is retried, and (optionally) how many sub-commands a worker process
+    # runs before it is replaced with a fresh one.
+    _mp_retries_ = 0
+    _mp_max_tasks_per_worker_ = None
+
     def __init__(self, istream=None, ostream=None, estream=None):
 
         self.interactive = False
@@ -213,18 +220,30 @@ class Command(ImplicitContextSensitiveObject):
         self._stash = None
         self._quiet = None
 
+        (self.name, self.shortname) = self.get_names()
+
+    @classmethod
+    def get_names(cls):
+        """
+        Return a (name, shortname) tuple for this command class.  The name is
+        derived from the class name (i.e. 'HelloWorld' -> 'hello-world'), and
+        the shortname is either ``_shortname_`` or the first letter of each
+        token in the class name (i.e. 'hw').
+        """
         regex = COMMAND_CLASS_REGEX
-        tokens = [ t for t in regex.findall(self.__class__.__name__) ]
+        tokens = [ t for t in regex.findall(cls.__name__) ]
         if tokens[-1] == 'Command':
             tokens = tokens[:-1]
 
-        self.name = '-'.join(t for t in tokens).lower()
-        if self._shortname_ is not None:
-            self.shortname = self._shortname_
+        name = '-'.join(t for t in tokens).lower()
+        if cls._shortname_ is not None:
+            shortname = cls._shortname_
         elif len(tokens) > 1:
-            self.shortname = ''.join(t[0] for t in tokens).lower()
+            shortname = ''.join(t[0] for t in tokens).lower()
         else:
-            self.shortname = self.name
+            shortname = name
+
+        return (name, shortname)
 
     def __enter__(self):
         if not Command.__active_command__:
@@ -463,17 +463,19 @@ class PrintPytestFailures(InvariantAwareCommand):
         elements = tree.findall('.//testcase/[failure]')
 
         dicts = []
-        rows = [(
-            'Index',
-            'Start Time',
-            'Module',
-            'Run Time',
-            'Failure',
-        )]
-        #import ipdb
-        #ipdb.set_trace()
-
-        for (i, e) in enumerate(elements, start=1):
+
+        def rows():
+            yield (
+                'Index',
+                'Start Time',
+                'Module',
+                'Run Time',
+                'Failure',
+            )
+            for (i, e) in enumerate(elements, start=1):
+                yield process_element(i, e)
+
+        def process_element(i, e):
             # Example attributes:
             # {'classname': 'test_sql_files.TestParquet',
             #  'name': 'test_sql[nonnull-non_equi_join:test_63.sql]',
@@ -498,10 +500,10 @@ class PrintPytestFailures(InvariantAwareCommand):
                 run_time,
                 short_failure_msg,
             ]
-            rows.append(row)
             a['failure_message'] = failure_msg
             a['failure_text'] = failure.text
             dicts.append(a)
+            return row
 
         k = Dict()
         k.banner = (f'Failures for {self._path}.',)
@@ -513,10 +515,11 @@ class PrintPytestFailures(InvariantAwareCommand):
             repeat(str.ljust),
         )
         k.output = self.ostream
+        k.stream = 'spill'
         if self.no_fancy_unicode_chars:
-            render_text_table(rows, **k)
+            render_text_table(rows(), **k)
         else:
-            render_fancy_text_table(rows, **k)
+            render_fancy_text_table(rows(), **k)
 
         json_path = path.replace('.xml', '-failures.json')
         with open(json_path, 'w') as f:
@@ -603,27 +606,26 @@ class ComparePytestResults(InvariantAwareCommand):
         for test_id in chain(left.keys(), right.keys()):
             ids.add(test_id)
 
-        rows = [(
-            'Module',
-            'Test:Line',
-            'Left',
-            'Right',
-        )]
-
-        for test_id in sorted(ids):
-            l = left.get(test_id)
-            r = right.get(test_id)
-            t = l or r
-            if not self.include_successful_tests:
-                if l and r and l.success and r.success:
-                    continue
-            row = [
-                t.classname,
-                t.test_line,
-                '' if not l else l.result,
-                '' if not r else r.result,
-            ]
-            rows.append(row)
+        def rows():
+            yield (
+                'Module',
+                'Test:Line',
+                'Left',
+                'Right',
+            )
+            for test_id in sorted(ids):
+                l = left.get(test_id)
+                r = right.get(test_id)
+                t = l or r
+                if not self.include_successful_tests:
+                    if l and r and l.success and r.success:
+                        continue
+                yield [
+                    t.classname,
+                    t.test_line,
+                    '' if not l else l.result,
+                    '' if not r else r.result,
+                ]
 
         k = Dict()
         k.banner = (
@@ -637,10 +639,11 @@ class ComparePytestResults(InvariantAwareCommand):
             (str.center,),
         )
         k.output = self.ostream
+        k.stream = 'spill'
         if self.no_fancy_unicode_chars:
-            render_text_table(rows, **k)
+            render_text_table(rows(), **k)
         else:
-            render_fancy_text_table(rows, **k)
+            render_fancy_text_table(rows(), **k)
 
 class GenerateDdCommands(InvariantAwareCommand):
     """
@@ -720,4 +723,39 @@ class SetTimestampForFile(InvariantAwareCommand):
         os.utime(path, (timestamp, timestamp))
         out(f'Set {path} to {datetime.fromtimestamp(timestamp)}.')
 
+class BenchmarkRenderTable(InvariantAwareCommand):
+    """
+    Times render_table() in each theme against the old per-cell renderer.
+    """
+
+    rows = None
+    _rows = None
+    class RowsArg(PositiveIntegerInvariant):
+        _help = "Number of rows in the table (defaults to 100000)."
+        _mandatory = False
+
+    cols = None
+    _cols = None
+    class ColsArg(PositiveIntegerInvariant):
+        _help = "Number of columns in the table (defaults to 10)."
+        _mandatory = False
+
+    repeats = None
+    _repeats = None
+    class RepeatsArg(PositiveIntegerInvariant):
+        _help = "Number of runs to take the best of (defaults to 3)."
+        _mandatory = False
+
+    def run(self):
+        import io
+        from .util import benchmark_render_table
+        output = io.StringIO()
+        benchmark_render_table(
+            rows=self._rows or 100000,
+            cols=self._cols or 10,
+            repeats=self._repeats or 3,
+            output=output,
+        )
+        self._out(output.getvalue())
+
 # vim:set ts=8 sw=4 sts=4 tw=80 et                                             :
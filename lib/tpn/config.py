@@ -4,9 +4,12 @@
 import os
 import re
 import sys
+import json
 import stat
 import base64
+import hashlib
 import inspect
+import tempfile
 import subprocess
 
 from abc import (
@@ -72,6 +75,13 @@ CONF_DIR = join_path(LIB_DIR, '../conf')
 LOGS_DIR = join_path(LIB_DIR, '../logs')
 DATA_DIR = join_path(LIB_DIR, '../data')
 
+# Bump this whenever the layout of the persisted config snapshot changes.
+CONFIG_SNAPSHOT_VERSION = 1
+
+# Matches environment variable references in config values ($FOO, ${FOO} and
+# %FOO%), so their values can be made part of a snapshot's key.
+ENV_VAR_PATTERN = re.compile(r'\$(\w+)|\$\{([^}]*)\}|%(\w+)%')
+
 #fixme: revisit these assertions
 #assert LIB_DIR.endswith('lib'), LIB_DIR
 #
@@ -141,6 +151,11 @@ def _clear_config_class_if_already_set():
 #===============================================================================
 class Config(RawConfigParser):
 
+    # If True, load() persists a snapshot of the fully-resolved configuration
+    # under data_dir and reuses it on subsequent loads for as long as the
+    # config files and environment it was derived from are unchanged.
+    _snapshot_ = True
+
     def __init__(self, options=None):
         RawConfigParser.__init__(self)
 
@@ -152,6 +167,8 @@ class Config(RawConfigParser):
 
         self.files = None
         self.filename = None
+        self.from_snapshot = False
+        self._absdirs = None
         self._is_production = None
         self._multiline_pattern = re.compile(r'([^\s].*?)([\s]+\\)?')
 
@@ -209,13 +226,10 @@ class Config(RawConfigParser):
         except AttributeError:
             return None
 
-    def _absdir(self, name, section='main'):
+    def _expand_path(self, p, section, name):
         count = 0
         total = 0
         max_total = 10
-        p = self.get(section, name)
-        if not p:
-            return
         while count != 2 and total < max_total:
             count = 0
             total += 1
@@ -236,7 +250,23 @@ class Config(RawConfigParser):
             msg = "Exceeded user/var path recursion depth for %s.%s." % args
             raise RuntimeError(msg)
 
-        return abspath(p)
+        return p
+
+    def _absdir(self, name, section='main'):
+        p = self.get(section, name)
+        if not p:
+            return
+
+        if self._absdirs:
+            try:
+                (raw, path) = self._absdirs[section][name]
+            except KeyError:
+                pass
+            else:
+                if raw == p:
+                    return path
+
+        return abspath(self._expand_path(p, section, name))
 
     @property
     @memoize
@@ -297,7 +327,7 @@ class Config(RawConfigParser):
         """
         pass
 
-    def load(self, filename=None):
+    def _get_config_files(self, filename=None):
         info = []
         self.discover_config_files(info)
 
@@ -320,13 +350,117 @@ class Config(RawConfigParser):
         if filename:
             files.append(filename)
 
-        with open(files[0], 'r') as f:
+        return files
+
+    def _get_snapshot_path(self, files):
+        cls = self.__class__
+        key = json.dumps([cls.__module__, cls.__name__, files])
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+        name = '%s-%s.json' % (cls.namespace, digest)
+        return join_path(cls.data_dir, 'config-snapshot', name)
+
+    def _get_snapshot_key(self, files, env_vars):
+        stats = []
+        for path in files:
             try:
-                self.read_file(f)
-            except AttributeError:
-                self.readfp(f, files[0])
+                st = os.stat(path)
+            except OSError:
+                stats.append([path, None, None])
+            else:
+                stats.append([path, st.st_mtime_ns, st.st_size])
+
+        env = dict((name, os.environ.get(name)) for name in env_vars)
+        return {'files': stats, 'env': env}
+
+    def _get_referenced_env_vars(self):
+        names = set(('HOME', 'USERPROFILE'))
+        sections = [ self.defaults() ] + [
+            dict(self.items(section, raw=True)) for section in self.sections()
+        ]
+        for values in sections:
+            for value in values.values():
+                if not value:
+                    continue
+                for groups in ENV_VAR_PATTERN.findall(value):
+                    names.update(g for g in groups if g)
+        return sorted(names)
+
+    def _load_snapshot(self, files):
+        try:
+            path = self._get_snapshot_path(files)
+            with open(path, 'r') as f:
+                snapshot = json.load(f)
+            if snapshot.get('version') != CONFIG_SNAPSHOT_VERSION:
+                return False
+            key = snapshot['key']
+            if key != self._get_snapshot_key(files, key['env']):
+                return False
+            self.read_dict(snapshot['sections'])
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return False
+
+        self._absdirs = snapshot.get('absdirs')
+        return True
+
+    def _save_snapshot(self, files):
+        absdirs = {}
+        for section in self.sections():
+            for (name, value) in self.items(section, raw=True):
+                if not value:
+                    continue
+                try:
+                    p = self._expand_path(value, section, name)
+                except RuntimeError:
+                    continue
+                # Relative paths resolve against the current directory, so
+                # they can't be precomputed.
+                if os.path.isabs(p):
+                    absdirs.setdefault(section, {})[name] = [value, abspath(p)]
+
+        sections = { self.default_section: dict(self.defaults()) }
+        for section in self.sections():
+            sections[section] = dict(self._sections[section])
+
+        snapshot = {
+            'version': CONFIG_SNAPSHOT_VERSION,
+            'key': self._get_snapshot_key(
+                files,
+                self._get_referenced_env_vars(),
+            ),
+            'sections': sections,
+            'absdirs': absdirs,
+        }
+
+        try:
+            path = self._get_snapshot_path(files)
+            snapshot_dir = dirname(path)
+            if not isdir(snapshot_dir):
+                os.makedirs(snapshot_dir)
+            (fd, tmp) = tempfile.mkstemp(dir=snapshot_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, path)
+        except (IOError, OSError):
+            pass
+
+        self._absdirs = absdirs
+
+    def load(self, filename=None):
+        files = self._get_config_files(filename)
+
+        snapshot = self._snapshot_
+        self.from_snapshot = snapshot and self._load_snapshot(files)
+        if not self.from_snapshot:
+            with open(files[0], 'r') as f:
+                try:
+                    self.read_file(f)
+                except AttributeError:
+                    self.readfp(f, files[0])
+
+            self.read(files[1:])
 
-        self.read(files[1:])
+            if snapshot:
+                self._save_snapshot(files)
 
         self.files = files
         self.filename = filename
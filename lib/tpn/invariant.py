@@ -677,8 +677,10 @@ class InvariantDetail(object):
 class InvariantAwareObject(object):
     _existing_ = None
 
-    __filter = lambda _, n: (n[0] != '_' and endswith(n, SUFFIXES))
-    __convert = lambda _, n: '_'.join(t.lower() for t in n[:-1])
+    __filter = staticmethod(
+        lambda n: (n[0] != '_' and endswith(n, SUFFIXES))
+    )
+    __convert = staticmethod(lambda n: '_'.join(t.lower() for t in n[:-1]))
     __pattern = re.compile('[A-Z][^A-Z]*')
     __inner_classes_pattern = re.compile(
         r'    class ([^\s]+(%s))\(.*' % (
@@ -690,56 +692,90 @@ class InvariantAwareObject(object):
         self._long_opts = kwds.get('long_opts', {})
         self._short_opts = kwds.get('short_opts', {})
 
-        f = self.__filter
-        c = self.__convert
-        p = self.__pattern
+        (classes, names, order) = self._get_invariant_schema()
+
+        instances = {
+            name: classes[name](self, name) for (_, name) in order
+        }
+
+        self._invariants = instances
+        self._invariant_names = names
+        self._invariant_order = order
+        self._invariant_classes = classes
+
+        self._invariants_processed = list()
+
+    @classmethod
+    def _get_invariant_schema(cls):
+        """
+        Returns a (classes, names, order) tuple describing the invariants of
+        this class.  This is computed once per class and cached in the class's
+        own __dict__ (so subclasses get their own schema), as it's too costly
+        to redo every time an object is constructed.  Callers must treat the
+        returned objects as read-only.
+        """
+        schema = cls.__dict__.get('_invariant_schema_')
+        if schema is None:
+            schema = cls._build_invariant_schema()
+            type.__setattr__(cls, '_invariant_schema_', schema)
+        return schema
+
+    @classmethod
+    def _build_invariant_schema(cls):
+        f = cls.__filter
+        c = cls.__convert
+        p = cls.__pattern
 
         classes = dict(
-            (c(t), getattr(self, n)) for (n, t) in [
-                (n, p.findall(n)) for n in filter(f, dir(self))
+            (c(t), getattr(cls, n)) for (n, t) in [
+                (n, p.findall(n)) for n in filter(f, dir(cls))
             ]
         )
 
         names = dict((v.__name__, k) for (k, v) in classes.items())
 
-        cls = self.__class__
-        classname = cls.__name__
-        filename = inspect.getsourcefile(cls)
+        inner_names = cls._find_inner_class_names_in_source()
+        if inner_names is None:
+            # No source available (e.g. zipapps or .pyc-only deployments);
+            # fall back to definition order as recorded in the class dict.
+            inner_names = [
+                v.__name__ for (n, v) in cls.__dict__.items()
+                    if f(n) and inspect.isclass(v) and v.__name__ in names
+            ]
+
+        order = [ (i, names[n]) for (i, n) in enumerate(inner_names) ]
+
+        return (classes, names, order)
+
+    @classmethod
+    def _find_inner_class_names_in_source(cls):
+        """
+        Returns the names of the invariant classes defined in the body of this
+        class, in the order they appear in the source code, or None if the
+        source code can't be found.
+        """
+        try:
+            filename = inspect.getsourcefile(cls)
+        except TypeError:
+            return
+        if not filename:
+            return
+
         lines = linecache.getlines(filename)
-        lines_len = len(lines)
-        prefix = 'class %s(' % classname
-        found = False
-        for i in range(lines_len):
-            line = lines[i]
+        prefix = 'class %s(' % cls.__name__
+        found = None
+        for (i, line) in enumerate(lines):
             if prefix in line:
                 found = i
                 break
 
-        if not found:
-            raise IOError('could not find source code for class')
+        if found is None:
+            return
 
         block = inspect.getblock(lines[found:])
         text = ''.join(block)
-        inner = self.__inner_classes_pattern
-
-        order = [
-            (i, names[n[0]]) for (i, n) in enumerate(inner.findall(text))
-        ]
-
-        instances = {
-            name: cls(self, name)
-                for (cls, name) in [
-                    (classes[name], name)
-                        for (_, name) in order
-                ]
-        }
-
-        self._invariants = instances
-        self._invariant_names = names
-        self._invariant_order = order
-        self._invariant_classes = classes
-
-        self._invariants_processed = list()
+        inner = cls.__inner_classes_pattern
+        return [ n[0] for n in inner.findall(text) ]
 
     def __setattr__(self, name, new_value):
         object.__setattr__(self, name, new_value)
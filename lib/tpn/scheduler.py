@@ -0,0 +1,312 @@
+"""
+Process-pool scheduler for running many tpn sub-commands in parallel.
+
+This backs the ``[n]@<command>`` multiprocess mode of ``python -m tpn.cli``:
+the parent command produces a list of argument lists (``command.results``),
+and the scheduler fans them out to a pool of worker processes, each running
+a ``tpn.cli.CLI`` instance fed from its own task queue.
+
+The parent hands a worker its next task as soon as the worker reports the
+previous one as done, so slow tasks don't hold up a fixed partition of the
+work.  Because the parent always knows which task each worker is running,
+a worker that dies mid-task (even via ``os._exit()`` or a signal) is
+detected and its task retried or failed, rather than silently lost.
+Workers report the outcome of every task on a shared feedback queue, which
+the parent uses to collect per-task exit codes, retry failures, recycle
+workers after ``max_tasks_per_worker`` tasks and display progress.
+"""
+
+#===============================================================================
+# Imports
+#===============================================================================
+import sys
+import time
+
+from queue import Empty
+
+from collections import (
+    deque,
+)
+
+from .util import (
+    SlotObject,
+)
+
+from .progressbar import (
+    format_meter,
+)
+
+#===============================================================================
+# Globals
+#===============================================================================
+# Feedback message kinds sent from workers to the parent.  Each message is a
+# tuple of (kind, pid, task_id[, returncode, error]).  The parent only acts
+# on TASK_FINISHED; it already knows when a task was handed to a worker.
+TASK_STARTED = 'start'
+TASK_FINISHED = 'done'
+
+# How long the parent waits on the feedback queue before checking on the
+# health of its workers.
+POLL_INTERVAL = 0.1
+
+# Minimum number of seconds between progress updates.
+PROGRESS_INTERVAL = 0.25
+
+#===============================================================================
+# Classes
+#===============================================================================
+class Task(SlotObject):
+    __slots__ = [
+        'id',
+        'args',
+        'attempts',
+        'returncode',
+        'error',
+        'pid',
+        'start_time',
+        'end_time',
+    ]
+    _defaults_ = {
+        'attempts': 0,
+    }
+
+    @property
+    def succeeded(self):
+        return self.returncode == 0
+
+    @property
+    def elapsed(self):
+        if self.start_time is None or self.end_time is None:
+            return
+        return self.end_time - self.start_time
+
+class _Worker(object):
+    def __init__(self, process, queue):
+        self.process = process
+        self.queue = queue
+        self.task_id = None
+        self.tasks_run = 0
+
+class Scheduler(object):
+    """
+    Runs each argument list in ``tasks`` as a tpn command in a pool of
+    ``nprocs`` worker processes.
+
+    ``kwds`` are the keywords used to construct each worker's ``CLI``
+    instance (i.e. program_name and module_names).  Tasks that exit with a
+    non-zero code (or whose worker dies) are retried up to ``retries``
+    times.  If ``max_tasks_per_worker`` is set, workers exit after running
+    that many tasks and are replaced with fresh processes.  Progress is
+    written to ``estream`` (if it's a terminal, unless ``progress`` says
+    otherwise).
+    """
+    def __init__(self, tasks, kwds, nprocs=None, retries=0,
+                 max_tasks_per_worker=None, estream=None, progress=None):
+        if not nprocs:
+            from multiprocessing import cpu_count
+            nprocs = cpu_count()
+
+        self.tasks = [
+            Task(id=i, args=list(args)) for (i, args) in enumerate(tasks)
+        ]
+        self.kwds = dict(kwds)
+        self.nprocs = nprocs
+        self.retries = retries
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self.estream = estream or sys.stderr
+        if progress is None:
+            try:
+                progress = self.estream.isatty()
+            except (AttributeError, ValueError):
+                progress = False
+        self.progress = progress
+
+        self.pending = deque(range(len(self.tasks)))
+        self.workers = dict()
+        self.feedback_queue = None
+
+        self.finished = 0
+        self.failed = list()
+        self.retried = 0
+        self.workers_started = 0
+        self.workers_lost = 0
+
+        self._start_time = None
+        self._last_progress = None
+
+    @property
+    def outstanding(self):
+        return len(self.tasks) - self.finished
+
+    def _start_worker(self):
+        from multiprocessing import Process, Queue
+        from .cli import run_mp
+
+        queue = Queue()
+        kwds = dict(self.kwds)
+        kwds['args_queue'] = queue
+        kwds['feedback_queue'] = self.feedback_queue
+        kwds['max_tasks'] = self.max_tasks_per_worker
+
+        p = Process(target=run_mp, kwargs=kwds)
+        p.daemon = True
+        p.start()
+        self.workers[p.pid] = _Worker(p, queue)
+        self.workers_started += 1
+
+    def _is_retiring(self, worker):
+        limit = self.max_tasks_per_worker
+        return bool(limit) and worker.tasks_run >= limit
+
+    def _maintain_workers(self):
+        """
+        Reap any workers that have exited, and start new ones as long as
+        there's outstanding work.
+        """
+        dead = [
+            (pid, w) for (pid, w) in self.workers.items()
+                if not w.process.is_alive()
+        ]
+        if dead:
+            # A worker's final feedback may still be sitting in the queue;
+            # process it before deciding whether it died mid-task.
+            self._drain_feedback()
+
+        for (pid, worker) in dead:
+            worker.process.join()
+            del self.workers[pid]
+            if worker.task_id is not None:
+                self.workers_lost += 1
+                task = self.tasks[worker.task_id]
+                code = worker.process.exitcode
+                error = 'worker %d died (exit code %s)' % (pid, code)
+                self._task_finished(task, code or 1, error)
+
+        # Workers that have hit max_tasks_per_worker are on their way out;
+        # don't count them towards the pool size.
+        active = sum(
+            1 for w in self.workers.values() if not self._is_retiring(w)
+        )
+        wanted = min(self.nprocs, self.outstanding)
+        while active < wanted:
+            self._start_worker()
+            active += 1
+
+    def _dispatch(self):
+        for worker in self.workers.values():
+            if not self.pending:
+                break
+            if worker.task_id is not None or self._is_retiring(worker):
+                continue
+            task = self.tasks[self.pending.popleft()]
+            task.attempts += 1
+            task.pid = worker.process.pid
+            task.start_time = time.time()
+            worker.task_id = task.id
+            worker.queue.put((task.id, task.args))
+
+    def _task_finished(self, task, returncode, error):
+        task.returncode = returncode
+        task.error = error
+        task.end_time = time.time()
+        if returncode != 0 and task.attempts <= self.retries:
+            self.retried += 1
+            self.pending.append(task.id)
+            return
+
+        self.finished += 1
+        if returncode != 0:
+            self.failed.append(task)
+        self._update_progress()
+
+    def _process_feedback(self, message):
+        (kind, pid, task_id) = message[:3]
+        if kind != TASK_FINISHED:
+            return
+        worker = self.workers.get(pid)
+        if not worker or worker.task_id != task_id:
+            # Already accounted for (e.g. the worker was reaped first).
+            return
+        (returncode, error) = message[3:]
+        worker.task_id = None
+        worker.tasks_run += 1
+        self._task_finished(self.tasks[task_id], returncode, error)
+
+    def _drain_feedback(self):
+        while True:
+            try:
+                message = self.feedback_queue.get_nowait()
+            except Empty:
+                break
+            self._process_feedback(message)
+
+    def _update_progress(self, force=False):
+        if not self.progress:
+            return
+        now = time.time()
+        last = self._last_progress
+        if not force and last and (now - last) < PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        meter = format_meter(
+            self.finished,
+            len(self.tasks),
+            now - self._start_time,
+        )
+        self.estream.write('\r%s failed: %d retried: %d workers: %d' % (
+            meter,
+            len(self.failed),
+            self.retried,
+            len(self.workers),
+        ))
+        self.estream.flush()
+
+    def _stop_workers(self):
+        for worker in self.workers.values():
+            if worker.process.is_alive():
+                worker.queue.put(None)
+        for worker in self.workers.values():
+            worker.process.join()
+        self.workers.clear()
+
+    def run(self):
+        """
+        Run all tasks to completion.  Returns True if every task succeeded.
+        """
+        from multiprocessing import Queue
+
+        self._start_time = time.time()
+        self.feedback_queue = Queue()
+
+        try:
+            while self.outstanding:
+                self._maintain_workers()
+                self._dispatch()
+                try:
+                    message = self.feedback_queue.get(timeout=POLL_INTERVAL)
+                except Empty:
+                    continue
+                self._process_feedback(message)
+                self._drain_feedback()
+        finally:
+            self._stop_workers()
+
+        if self.progress:
+            self._update_progress(force=True)
+            self.estream.write('\n')
+
+        for task in self.failed:
+            self.estream.write(
+                'error: task %d (%s) failed after %d attempt(s) '
+                'with exit code %s%s\n' % (
+                    task.id,
+                    ' '.join(str(a) for a in task.args),
+                    task.attempts,
+                    task.returncode,
+                    (': %s' % task.error) if task.error else '',
+                )
+            )
+
+        return not self.failed
+
+# vim:set ts=8 sw=4 sts=4 tw=78 et:
@@ -0,0 +1,374 @@
+"""
+Warm-interpreter server for the tpn CLI.
+
+``tpn serve`` starts a daemon that keeps an interpreter loaded with a fully
+initialized ``tpn.cli.CLI`` instance: every command module imported, every
+``CommandLine`` created and the ``Config`` object already parsed.  Clients
+connect over a Unix domain socket and send their argv, cwd and environment,
+plus their stdin/stdout/stderr file descriptors (via ``SCM_RIGHTS``).  The
+daemon forks a child per request, which adopts the client's descriptors,
+runs the command and reports the exit code back over the socket.
+
+This module is deliberately light on imports so that ``bin/tpn`` can use
+``run_client()`` without paying for ``tpn.cli`` (the whole point of the
+server is to avoid that cost).
+"""
+
+#===============================================================================
+# Imports
+#===============================================================================
+import os
+import sys
+import json
+import stat
+import errno
+import signal
+import socket
+import struct
+
+#===============================================================================
+# Globals
+#===============================================================================
+SOCKET_ENV_VAR = 'TPN_SERVER_SOCKET'
+DISABLE_ENV_VAR = 'TPN_NO_SERVER'
+
+# Request: a 4-byte big-endian length, then that many bytes of JSON.  The
+# client's stdio descriptors are attached to the first message as ancillary
+# data.  Response: the forked child's pid, followed by the command's exit
+# code, each as a 4-byte big-endian signed int.
+HEADER = struct.Struct('!I')
+INT = struct.Struct('!i')
+
+# struct ucred, as returned by getsockopt(SO_PEERCRED): pid, uid, gid.
+PEERCRED = struct.Struct('3i')
+
+STDIO_FDS = (0, 1, 2)
+
+# Arguments that cause the preloaded config object to be discarded in the
+# child so that the requested configuration file gets loaded instead.
+CONF_ARGS = ('-c', '--conf')
+
+#===============================================================================
+# Exceptions
+#===============================================================================
+class ServerError(BaseException):
+    pass
+
+class ServerAlreadyRunning(ServerError):
+    pass
+
+#===============================================================================
+# Helpers
+#===============================================================================
+def is_supported():
+    return (
+        os.name == 'posix' and
+        hasattr(socket, 'AF_UNIX') and
+        hasattr(socket, 'send_fds')
+    )
+
+def get_socket_path():
+    """
+    Return the path of the server's Unix domain socket.  This can be
+    overridden with the TPN_SERVER_SOCKET environment variable; otherwise,
+    a per-user location is used.  Either way, the socket's directory must
+    be owned by us with mode 0700 (see _check_socket_dir()).
+    """
+    path = os.environ.get(SOCKET_ENV_VAR)
+    if path:
+        return path
+
+    base = os.environ.get('XDG_RUNTIME_DIR')
+    if not base:
+        base = '/tmp/tpn-%d' % os.getuid()
+    return os.path.join(base, 'tpn.sock')
+
+def _check_socket_dir(dirname):
+    """
+    Return True if ``dirname`` is a real directory (not a symlink), owned by
+    us and accessible only by us.  Anything else could be controlled by
+    another local user, who would then receive our environment and stdio
+    descriptors, so the socket mustn't be used.
+    """
+    try:
+        st = os.lstat(dirname or '.')
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(st.st_mode) and
+        st.st_uid == os.getuid() and
+        stat.S_IMODE(st.st_mode) == 0o700
+    )
+
+def _get_peer_uid(sock):
+    """
+    Return the uid of the process on the other end of ``sock``, or None if
+    the platform doesn't tell us.
+    """
+    option = getattr(socket, 'SO_PEERCRED', None)
+    if option is None:
+        return
+    creds = sock.getsockopt(socket.SOL_SOCKET, option, PEERCRED.size)
+    (_, uid, _) = PEERCRED.unpack(creds)
+    return uid
+
+def _recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            return
+        buf += chunk
+    return bytes(buf)
+
+def _recv_int(sock):
+    data = _recv_exactly(sock, INT.size)
+    if data is None:
+        return
+    return INT.unpack(data)[0]
+
+def _connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return
+    return sock
+
+#===============================================================================
+# Client
+#===============================================================================
+def run_client(argv, path=None):
+    """
+    Run the tpn command ``argv`` via the server at ``path``.  Returns the
+    command's exit code, or None if no server is available (in which case
+    the caller should fall back to running the command in-process).
+    """
+    if not is_supported() or os.environ.get(DISABLE_ENV_VAR):
+        return
+    if argv and argv[0] == 'serve':
+        return
+
+    path = path or get_socket_path()
+    if not _check_socket_dir(os.path.dirname(path)):
+        return
+
+    sock = _connect(path)
+    if not sock:
+        return
+
+    with sock:
+        # Don't hand anything over unless the server is running as us.
+        if _get_peer_uid(sock) != os.getuid():
+            return
+
+        request = {
+            'argv': list(argv),
+            'cwd': os.getcwd(),
+            'env': dict(os.environ),
+        }
+        payload = json.dumps(request).encode('utf-8')
+        data = HEADER.pack(len(payload)) + payload
+        try:
+            sent = socket.send_fds(sock, [data], list(STDIO_FDS))
+            sock.sendall(data[sent:])
+        except OSError:
+            return
+
+        pid = _recv_int(sock)
+        if pid is None:
+            return
+
+        while True:
+            try:
+                code = _recv_int(sock)
+                break
+            except KeyboardInterrupt:
+                try:
+                    os.kill(pid, signal.SIGINT)
+                except OSError:
+                    pass
+
+    if code is None:
+        sys.stderr.write("error: tpn server exited without a result\n")
+        return 1
+    return code
+
+#===============================================================================
+# Server
+#===============================================================================
+def _check_peer(conn):
+    """
+    Only accept connections from processes running as the same user.
+    """
+    return _get_peer_uid(conn) in (None, os.getuid())
+
+def _recv_request(conn):
+    (data, fds, _, _) = socket.recv_fds(conn, 65536, len(STDIO_FDS))
+    if len(data) < HEADER.size:
+        rest = _recv_exactly(conn, HEADER.size - len(data))
+        if rest is None:
+            raise ServerError('truncated request header')
+        data += rest
+
+    (size,) = HEADER.unpack(data[:HEADER.size])
+    payload = data[HEADER.size:]
+    if len(payload) < size:
+        rest = _recv_exactly(conn, size - len(payload))
+        if rest is None:
+            raise ServerError('truncated request')
+        payload += rest
+
+    if len(fds) != len(STDIO_FDS):
+        raise ServerError('expected %d descriptors, got %d' % (
+            len(STDIO_FDS),
+            len(fds),
+        ))
+
+    return (json.loads(payload.decode('utf-8')), fds)
+
+def _adopt_stdio(fds):
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except (IOError, OSError, ValueError):
+            pass
+
+    for (fd, target) in zip(fds, STDIO_FDS):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    # The stream objects are reused (command instances were created with
+    # references to them during warm-up), but their buffering should follow
+    # the client's descriptors rather than the daemon's.
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.reconfigure(line_buffering=os.isatty(stream.fileno()))
+        except (AttributeError, IOError, OSError, ValueError):
+            pass
+
+def _run_request(cli, conn):
+    """
+    Runs in the forked child.  Never returns.
+    """
+    code = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        if not _check_peer(conn):
+            os._exit(1)
+
+        (request, fds) = _recv_request(conn)
+        conn.sendall(INT.pack(os.getpid()))
+
+        _adopt_stdio(fds)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+
+        argv = list(request['argv'])
+        sys.argv = [ cli.program_name ] + argv
+        if any(a in CONF_ARGS or a.startswith('--conf=') for a in argv):
+            from .config import _clear_config_if_already_created
+            _clear_config_if_already_created()
+
+        code = cli.dispatch(argv)
+
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (1 if e.code else 0)
+    except KeyboardInterrupt:
+        code = 130
+    except BaseException:
+        import traceback
+        traceback.print_exc()
+        code = 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except BaseException:
+                pass
+        try:
+            conn.sendall(INT.pack(code))
+        except BaseException:
+            pass
+        os._exit(code)
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt()
+
+def _bind(path):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.lexists(dirname):
+        os.makedirs(dirname, mode=0o700)
+    if not _check_socket_dir(dirname):
+        raise ServerError(
+            "refusing to serve on %s: %s must be a directory owned by uid "
+            "%d with mode 0700" % (path, dirname or '.', os.getuid())
+        )
+
+    if os.path.exists(path):
+        sock = _connect(path)
+        if sock:
+            sock.close()
+            raise ServerAlreadyRunning("already running on %s" % path)
+        os.unlink(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(old_umask)
+    sock.listen(128)
+    return sock
+
+def serve(cli, path=None, out=None):
+    """
+    Serve requests for ``cli`` (a warmed-up ``tpn.cli.CLI`` instance) on the
+    Unix domain socket at ``path`` until interrupted.
+    """
+    if not is_supported():
+        raise ServerError('tpn serve requires Unix domain socket support')
+
+    path = path or get_socket_path()
+    sock = _bind(path)
+
+    if out:
+        out("serving on %s (pid %d)" % (path, os.getpid()))
+
+    # Children report their exit codes to the client directly, so there's
+    # no need to wait on them; let the kernel reap them.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _terminate)
+
+    try:
+        while True:
+            try:
+                (conn, _) = sock.accept()
+            except InterruptedError:
+                continue
+
+            sys.stdout.flush()
+            sys.stderr.flush()
+
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                _run_request(cli, conn)
+
+            conn.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+# vim:set ts=8 sw=4 sts=4 tw=78 et:
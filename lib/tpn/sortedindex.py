@@ -0,0 +1,531 @@
+"""
+Disk-resident sorted index.
+
+A ``SortedIndex`` is a memory-mapped counterpart of util.SortedCollection
+for fixed-width records: a 64-bit key (``int`` or ``float``) plus a 64-bit
+item offset (typically the position of the corresponding record in some
+other file).  The records live in a single file, sorted by key, so lookups
+are a binary search over the memory map and only touch O(log n) pages; the
+index itself is never loaded into memory.
+
+Indexes are built from unsorted input with an external merge sort (sorted
+runs of ``run_size`` records are spilled to temporary files and then
+merged), so they can be much larger than memory.  Afterwards, new records
+are appended to a log next to the index (``<path>.log``) and kept in memory
+until compact() merges them into a new index file.  Lookups consult both,
+so appended records are visible immediately.  Appended records are only
+sorted when they're next looked up (or compacted), so a run of appends
+costs O(1) each.
+
+File layout: a 32 byte header (magic, key kind, record count, generation),
+followed by the records, each a little-endian (key, offset) pair.  The log
+is a 16 byte header (magic, generation) followed by records.  compact()
+writes the new index with the next generation before removing the log, so
+if it's interrupted in between, the leftover log (whose generation no
+longer matches) is recognized as already merged and discarded.
+"""
+
+#===============================================================================
+# Imports
+#===============================================================================
+import os
+import mmap
+import heapq
+import struct
+import tempfile
+
+from bisect import (
+    bisect_left,
+    bisect_right,
+)
+
+from operator import (
+    itemgetter,
+)
+
+from os.path import (
+    isdir,
+    exists,
+    dirname,
+    abspath,
+)
+
+#===============================================================================
+# Globals
+#===============================================================================
+INDEX_MAGIC = b'TPNSIDX1'
+LOG_MAGIC = b'TPNSLOG1'
+
+INDEX_HEADER = struct.Struct('<8s8sQQ')
+LOG_HEADER = struct.Struct('<8sQ')
+
+# Key kinds and their typecodes.
+KEY_TYPECODES = {
+    'int': 'q',
+    'float': 'd',
+}
+
+RECORD_STRUCTS = {
+    kind: struct.Struct('<%sQ' % typecode)
+        for (kind, typecode) in KEY_TYPECODES.items()
+}
+
+RECORD_SIZE = 16
+
+# Number of records sorted in memory per run when building an index.
+RUN_SIZE = 1 << 20
+
+# Number of records read or written at a time when streaming.
+IO_RECORDS = 1 << 14
+
+# append() compacts automatically once this many records are pending.
+COMPACT_THRESHOLD = 1 << 20
+
+#===============================================================================
+# Exceptions
+#===============================================================================
+class SortedIndexError(BaseException):
+    pass
+
+#===============================================================================
+# Helpers
+#===============================================================================
+def _get_record_struct(kind):
+    try:
+        return RECORD_STRUCTS[kind]
+    except KeyError:
+        raise SortedIndexError("unknown key kind: %r" % kind)
+
+def _iter_records(f, record):
+    """
+    Yield (key, offset) tuples from the file object ``f``, ignoring any
+    trailing partial record.
+    """
+    size = IO_RECORDS * record.size
+    while True:
+        data = f.read(size)
+        if not data:
+            break
+        end = len(data) - (len(data) % record.size)
+        yield from record.iter_unpack(data[:end])
+        if end != len(data):
+            break
+
+def _write_records(f, record, records):
+    """
+    Write ``records`` to ``f``.  Returns the number written.
+    """
+    count = 0
+    pack = record.pack
+    batch = []
+    for (key, offset) in records:
+        batch.append(pack(key, offset))
+        if len(batch) == IO_RECORDS:
+            f.write(b''.join(batch))
+            count += len(batch)
+            batch = []
+    if batch:
+        f.write(b''.join(batch))
+        count += len(batch)
+    return count
+
+def _write_index(path, kind, records, generation=0):
+    """
+    Write the already sorted ``records`` as a new index at ``path``.  The
+    file is written under a temporary name and renamed into place.
+    """
+    record = _get_record_struct(kind)
+    dirname_ = dirname(abspath(path))
+    if not isdir(dirname_):
+        os.makedirs(dirname_, exist_ok=True)
+    (fd, tmp) = tempfile.mkstemp(dir=dirname_, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            header = INDEX_HEADER.pack(
+                INDEX_MAGIC,
+                kind.encode(),
+                0,
+                generation,
+            )
+            f.write(header)
+            count = _write_records(f, record, records)
+            f.seek(0)
+            f.write(INDEX_HEADER.pack(
+                INDEX_MAGIC,
+                kind.encode(),
+                count,
+                generation,
+            ))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return count
+
+def external_sort(records, kind='int', run_size=None, tmpdir=None):
+    """
+    Sort an iterable of (key, offset) pairs by key, spilling sorted runs of
+    ``run_size`` records to temporary files in ``tmpdir``.  Returns an
+    iterator over the sorted records; the sort is stable.  The temporary
+    files are removed once the iterator is exhausted (or closed).
+    """
+    record = _get_record_struct(kind)
+    run_size = run_size or RUN_SIZE
+    key = itemgetter(0)
+
+    runs = []
+    try:
+        run = []
+        for item in records:
+            run.append(item)
+            if len(run) == run_size:
+                run.sort(key=key)
+                f = tempfile.TemporaryFile(dir=tmpdir)
+                _write_records(f, record, run)
+                runs.append(f)
+                run = []
+        run.sort(key=key)
+    except BaseException:
+        for f in runs:
+            f.close()
+        raise
+
+    if not runs:
+        return iter(run)
+
+    def merge():
+        try:
+            iterables = []
+            for f in runs:
+                f.seek(0)
+                iterables.append(_iter_records(f, record))
+            iterables.append(iter(run))
+            yield from heapq.merge(*iterables, key=key)
+        finally:
+            for f in runs:
+                f.close()
+
+    return merge()
+
+#===============================================================================
+# Classes
+#===============================================================================
+class SortedIndex(object):
+    """
+    A sorted index of (key, offset) records stored at ``path``.  If ``path``
+    doesn't exist, an empty index with keys of ``kind`` ('int' or 'float')
+    is created.
+
+    The find methods mirror SortedCollection's, returning the matching
+    (key, offset) record or raising ValueError.  Records with equal keys
+    are kept in the order they were added.
+    """
+    def __init__(self, path, kind=None):
+        self.path = path
+        self.log_path = path + '.log'
+        self._map = None
+        self._keys = None
+        self._offsets = None
+        self._log = None
+
+        if not exists(path):
+            _write_index(path, kind or 'int', ())
+        self._open()
+        if kind and kind != self.kind:
+            self.close()
+            raise SortedIndexError(
+                "%s has %s keys, not %s" % (path, self.kind, kind)
+            )
+
+        # Appended records, in the order they were added; _pending_keys is
+        # None until they've been sorted (see _sort_pending()).
+        self._pending = []
+        self._pending_keys = []
+        if exists(self.log_path):
+            self._load_log()
+
+    @classmethod
+    def build(cls, path, records, kind='int', run_size=None):
+        """
+        Build a new index at ``path`` from an iterable of (key, offset)
+        pairs in any order, replacing whatever was there.
+        """
+        if exists(path + '.log'):
+            os.unlink(path + '.log')
+        tmpdir = dirname(abspath(path))
+        sorted_records = external_sort(records, kind, run_size, tmpdir)
+        _write_index(path, kind, sorted_records)
+        return cls(path, kind)
+
+    #===========================================================================
+    # Internal Methods
+    #===========================================================================
+    def _open(self):
+        with open(self.path, 'rb') as f:
+            header = f.read(INDEX_HEADER.size)
+            if len(header) != INDEX_HEADER.size:
+                raise SortedIndexError("bad index: %s" % self.path)
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, kind, count, generation) = INDEX_HEADER.unpack(header)
+        if magic != INDEX_MAGIC:
+            raise SortedIndexError("bad index: %s" % self.path)
+        self.kind = kind.rstrip(b'\0').decode()
+        self.record = _get_record_struct(self.kind)
+        self.count = count
+        self.generation = generation
+
+        end = INDEX_HEADER.size + count * RECORD_SIZE
+        if len(self._map) < end:
+            raise SortedIndexError("truncated index: %s" % self.path)
+        # Strided views over the records: even words are keys, odd words
+        # are offsets.  bisect works on these directly.
+        view = memoryview(self._map)[INDEX_HEADER.size:end]
+        self._keys = view.cast(KEY_TYPECODES[self.kind])[0::2]
+        self._offsets = view.cast('Q')[1::2]
+        view.release()
+
+    def _release(self):
+        for view in (self._keys, self._offsets):
+            if view is not None:
+                view.release()
+        self._keys = self._offsets = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def _load_log(self):
+        """
+        Load the pending records from the log, unless it belongs to an
+        earlier generation of the index (i.e. compact() merged it, but was
+        interrupted before removing it), in which case it's removed.  A
+        trailing partial record (from an interrupted append) is truncated.
+        """
+        with open(self.log_path, 'rb') as f:
+            header = f.read(LOG_HEADER.size)
+            generation = None
+            if len(header) == LOG_HEADER.size:
+                (magic, generation) = LOG_HEADER.unpack(header)
+                if magic != LOG_MAGIC:
+                    raise SortedIndexError("bad log: %s" % self.log_path)
+            if generation == self.generation:
+                self._pending.extend(_iter_records(f, self.record))
+                self._pending_keys = None
+
+        if generation != self.generation:
+            os.unlink(self.log_path)
+            return
+
+        size = LOG_HEADER.size + len(self._pending) * RECORD_SIZE
+        if os.stat(self.log_path).st_size != size:
+            os.truncate(self.log_path, size)
+
+    def _sort_pending(self):
+        if self._pending_keys is None:
+            # Stable, so records with equal keys stay in the order they
+            # were added.
+            self._pending.sort(key=itemgetter(0))
+            self._pending_keys = [ key for (key, _) in self._pending ]
+
+    def _record(self, i):
+        return (self._keys[i], self._offsets[i])
+
+    def _pending_record(self, j):
+        return self._pending[j]
+
+    def _iter_main(self):
+        keys = self._keys
+        offsets = self._offsets
+        for start in range(0, self.count, IO_RECORDS):
+            stop = min(start + IO_RECORDS, self.count)
+            yield from zip(keys[start:stop].tolist(),
+                           offsets[start:stop].tolist())
+
+    def _before(self, i, j):
+        """
+        Return the greater of the main record before i and the pending
+        record before j (pending wins ties, it was added later).
+        """
+        if i and j:
+            if self._pending_keys[j-1] >= self._keys[i-1]:
+                return self._pending_record(j-1)
+            return self._record(i-1)
+        if j:
+            return self._pending_record(j-1)
+        if i:
+            return self._record(i-1)
+
+    def _at(self, i, j):
+        """
+        Return the lesser of the main record at i and the pending record
+        at j (main wins ties).
+        """
+        has_main = i < self.count
+        has_pending = j < len(self._pending_keys)
+        if has_main and has_pending:
+            if self._pending_keys[j] < self._keys[i]:
+                return self._pending_record(j)
+            return self._record(i)
+        if has_pending:
+            return self._pending_record(j)
+        if has_main:
+            return self._record(i)
+
+    #===========================================================================
+    # Public Methods
+    #===========================================================================
+    def __len__(self):
+        return self.count + len(self._pending)
+
+    def __iter__(self):
+        """
+        Yield every (key, offset) record in key order.
+        """
+        self._sort_pending()
+        pending = list(self._pending)
+        return heapq.merge(self._iter_main(), pending, key=itemgetter(0))
+
+    def __contains__(self, key):
+        try:
+            self.find(key)
+        except ValueError:
+            return False
+        return True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def append(self, key, offset):
+        """
+        Add a record.  It's written to the log and visible to lookups
+        straight away; compact() merges it into the index proper.
+        """
+        if self._log is None:
+            self._log = open(self.log_path, 'ab')
+            if not self._log.tell():
+                self._log.write(LOG_HEADER.pack(LOG_MAGIC, self.generation))
+        self._log.write(self.record.pack(key, offset))
+        self._pending.append((key, offset))
+        self._pending_keys = None
+        if len(self._pending) >= COMPACT_THRESHOLD:
+            self.compact()
+
+    def extend(self, records):
+        for (key, offset) in records:
+            self.append(key, offset)
+
+    def flush(self):
+        if self._log is not None:
+            self._log.flush()
+
+    def compact(self):
+        """
+        Merge the pending records into a new index file (of the next
+        generation) and remove the log.  Returns the number of records
+        merged.
+        """
+        count = len(self._pending)
+        if not count:
+            return 0
+        self.flush()
+        self._sort_pending()
+        records = heapq.merge(
+            self._iter_main(),
+            self._pending,
+            key=itemgetter(0),
+        )
+        _write_index(self.path, self.kind, records, self.generation + 1)
+
+        self._release()
+        self._open()
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        os.unlink(self.log_path)
+        self._pending = []
+        self._pending_keys = []
+        return count
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        self._release()
+
+    def range(self, lo=None, hi=None):
+        """
+        Yield the records with lo <= key <= hi, in key order.  Bounds of
+        None are open-ended.
+        """
+        self._sort_pending()
+        keys = self._keys
+        pending_keys = self._pending_keys
+        (i, j) = (0, 0)
+        if lo is not None:
+            i = bisect_left(keys, lo)
+            j = bisect_left(pending_keys, lo)
+        (stop, pending_stop) = (self.count, len(pending_keys))
+        if hi is not None:
+            stop = bisect_right(keys, hi)
+            pending_stop = bisect_right(pending_keys, hi)
+
+        main = (self._record(x) for x in range(i, stop))
+        pending = (self._pending_record(x) for x in range(j, pending_stop))
+        return heapq.merge(main, pending, key=itemgetter(0))
+
+    def find(self, k):
+        'Return first record with a key == k.  Raise ValueError if not found.'
+        self._sort_pending()
+        record = self._at(bisect_left(self._keys, k),
+                          bisect_left(self._pending_keys, k))
+        if record and record[0] == k:
+            return record
+        raise ValueError('No item found with key equal to: %r' % (k,))
+
+    def find_le(self, k):
+        'Return last record with a key <= k.  Raise ValueError if not found.'
+        self._sort_pending()
+        record = self._before(bisect_right(self._keys, k),
+                              bisect_right(self._pending_keys, k))
+        if record:
+            return record
+        raise ValueError('No item found with key at or below: %r' % (k,))
+
+    def find_lt(self, k):
+        'Return last record with a key < k.  Raise ValueError if not found.'
+        self._sort_pending()
+        record = self._before(bisect_left(self._keys, k),
+                              bisect_left(self._pending_keys, k))
+        if record:
+            return record
+        raise ValueError('No item found with key below: %r' % (k,))
+
+    def find_ge(self, k):
+        'Return first record with a key >= k.  Raise ValueError if not found.'
+        self._sort_pending()
+        record = self._at(bisect_left(self._keys, k),
+                          bisect_left(self._pending_keys, k))
+        if record:
+            return record
+        raise ValueError('No item found with key at or above: %r' % (k,))
+
+    def find_gt(self, k):
+        'Return first record with a key > k.  Raise ValueError if not found.'
+        self._sort_pending()
+        record = self._at(bisect_right(self._keys, k),
+                          bisect_right(self._pending_keys, k))
+        if record:
+            return record
+        raise ValueError('No item found with key above: %r' % (k,))
+
+# vim:set ts=8 sw=4 sts=4 tw=78 et:
@@ -0,0 +1,360 @@
+"""
+Content-addressed object store.
+
+Objects (``SlotObject``s, ``Dict``s, or anything else canonical_bytes() can
+encode) are stored as zlib-compressed canonical encodings, addressed by the
+SHA256 of the encoding.  Identical objects therefore map to the same blob
+and are only ever stored once.  Like git, new objects are written "loose",
+one file per object under ``<root>/ab/cdef...`` (see sha256_to_path()), and
+can later be packed: many objects concatenated into a single ``.pack`` file
+with a sorted ``.idx`` alongside it for lookups.  Pack and index files are
+read via memory maps.
+
+SlotObjects are encoded with canonical_bytes(obj, slots=True): the class
+name and every entry in __slots__, including any that _to_dict() leaves
+out, so they read back exactly as they were stored.  The address is
+therefore a digest of that full encoding, not SlotObject.sha256, which
+only covers _to_dict().
+"""
+
+#===============================================================================
+# Imports
+#===============================================================================
+import os
+import zlib
+import mmap
+import struct
+import hashlib
+
+from os.path import (
+    join,
+    isdir,
+    exists,
+)
+
+from .util import (
+    canonical_bytes,
+    canonical_loads,
+    sha256_to_path,
+    _write_file_atomically,
+)
+
+#===============================================================================
+# Globals
+#===============================================================================
+PACK_MAGIC = b'TPNPACK1'
+INDEX_MAGIC = b'TPNIDX01'
+
+# Index layout: magic, entry count, a 256 entry fan-out table (the number of
+# entries whose digest's first byte is <= i), then the entries themselves,
+# sorted by digest.
+INDEX_HEADER = struct.Struct('<8sQ')
+INDEX_FANOUT = struct.Struct('<256Q')
+INDEX_ENTRY = struct.Struct('<32sQQ')
+
+DIGEST_SIZE = 32
+
+COMPRESSION_LEVEL = 6
+
+# put_many() writes batches with at least this many new objects straight to
+# a new pack rather than as loose objects.
+PACK_THRESHOLD = 64
+
+#===============================================================================
+# Exceptions
+#===============================================================================
+class ObjectStoreError(BaseException):
+    pass
+
+class ObjectNotFound(ObjectStoreError):
+    pass
+
+class CorruptObject(ObjectStoreError):
+    pass
+
+#===============================================================================
+# Helpers
+#===============================================================================
+def _get_default_root():
+    from .config import Config
+    return join(Config.data_dir, 'objects')
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+#===============================================================================
+# Classes
+#===============================================================================
+class Pack(object):
+    """
+    A read-only pack: ``<name>.pack`` holds the compressed blobs back to
+    back, ``<name>.idx`` maps digests to (offset, size) within it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index = _map_file(path + '.idx')
+        self.data = _map_file(path + '.pack')
+
+        (magic, self.count) = INDEX_HEADER.unpack_from(self.index, 0)
+        if magic != INDEX_MAGIC:
+            raise CorruptObject("bad index: %s.idx" % path)
+        if self.data[:len(PACK_MAGIC)] != PACK_MAGIC:
+            raise CorruptObject("bad pack: %s.pack" % path)
+        self.fanout = INDEX_FANOUT.unpack_from(self.index, INDEX_HEADER.size)
+        self.entries_offset = INDEX_HEADER.size + INDEX_FANOUT.size
+
+    def _digest_at(self, i):
+        start = self.entries_offset + i * INDEX_ENTRY.size
+        return self.index[start:start+DIGEST_SIZE]
+
+    def find(self, digest):
+        """
+        Return (offset, size) of the blob for the raw ``digest``, or None.
+        """
+        first = digest[0]
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._digest_at(mid) < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self._digest_at(lo) == digest:
+            start = self.entries_offset + lo * INDEX_ENTRY.size
+            (_, offset, size) = INDEX_ENTRY.unpack_from(self.index, start)
+            return (offset, size)
+
+    def read(self, offset, size):
+        return memoryview(self.data)[offset:offset+size]
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._digest_at(i)
+
+    def close(self):
+        self.index.close()
+        self.data.close()
+
+class ObjectStore(object):
+    """
+    Content-addressed store rooted at ``root`` (defaulting to
+    ``<Config.data_dir>/objects``).  Digests are hex strings.
+    """
+    def __init__(self, root=None, level=None):
+        self.root = root or _get_default_root()
+        self.level = COMPRESSION_LEVEL if level is None else level
+        self.packs_dir = join(self.root, 'packs')
+        self.packs = dict()
+
+    #===========================================================================
+    # Internal Methods
+    #===========================================================================
+    def _loose_path(self, digest):
+        return join(self.root, sha256_to_path(digest))
+
+    def _refresh_packs(self):
+        """
+        Open any packs written since we last looked.  Returns True if there
+        were new ones.
+        """
+        if not isdir(self.packs_dir):
+            return False
+        found = False
+        for name in os.listdir(self.packs_dir):
+            if not name.endswith('.idx'):
+                continue
+            path = join(self.packs_dir, name[:-len('.idx')])
+            if path not in self.packs:
+                self.packs[path] = Pack(path)
+                found = True
+        return found
+
+    def _find_packed(self, digest):
+        raw = bytes.fromhex(digest)
+        for pack in self.packs.values():
+            location = pack.find(raw)
+            if location:
+                return (pack, location)
+
+    def _read_compressed(self, digest):
+        try:
+            with open(self._loose_path(digest), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+        found = self._find_packed(digest)
+        if not found and self._refresh_packs():
+            found = self._find_packed(digest)
+        if not found:
+            raise ObjectNotFound(digest)
+        (pack, (offset, size)) = found
+        return pack.read(offset, size)
+
+    def _encode(self, obj):
+        blob = canonical_bytes(obj, slots=True)
+        return (hashlib.sha256(blob).hexdigest(), blob)
+
+    def _write_pack(self, items):
+        """
+        Write ``items`` (a dict of hex digest to compressed blob) as a new
+        pack.  The index is written last, so a pack is only visible once
+        it's complete.
+        """
+        entries = sorted(
+            (bytes.fromhex(digest), data) for (digest, data) in items.items()
+        )
+        name = hashlib.sha256(b''.join(d for (d, _) in entries)).hexdigest()
+        path = join(self.packs_dir, 'pack-%s' % name)
+
+        chunks = [ PACK_MAGIC ]
+        index = []
+        fanout = [0] * 256
+        offset = len(PACK_MAGIC)
+        for (digest, data) in entries:
+            chunks.append(data)
+            index.append(INDEX_ENTRY.pack(digest, offset, len(data)))
+            fanout[digest[0]] += 1
+            offset += len(data)
+
+        total = 0
+        for i in range(256):
+            total += fanout[i]
+            fanout[i] = total
+
+        header = INDEX_HEADER.pack(INDEX_MAGIC, len(entries))
+        _write_file_atomically(path + '.pack', b''.join(chunks))
+        _write_file_atomically(
+            path + '.idx',
+            header + INDEX_FANOUT.pack(*fanout) + b''.join(index),
+        )
+        self.packs[path] = Pack(path)
+        return path
+
+    #===========================================================================
+    # Public Methods
+    #===========================================================================
+    def __contains__(self, digest):
+        if exists(self._loose_path(digest)):
+            return True
+        if self._find_packed(digest):
+            return True
+        return self._refresh_packs() and bool(self._find_packed(digest))
+
+    def __iter__(self):
+        """
+        Yield the digest of every object in the store (packed objects that
+        were also written loose may be yielded twice).
+        """
+        self._refresh_packs()
+        for pack in list(self.packs.values()):
+            for digest in pack:
+                yield digest.hex()
+        for (dirpath, _, filenames) in os.walk(self.root):
+            prefix = os.path.basename(dirpath)
+            if len(prefix) != 2:
+                continue
+            for filename in filenames:
+                if not filename.endswith('.tmp'):
+                    yield prefix + filename
+
+    def digest(self, obj):
+        """
+        Return the digest ``obj`` would be stored under.
+        """
+        return self._encode(obj)[0]
+
+    def put(self, obj):
+        """
+        Store ``obj`` (if it isn't already) and return its digest.
+        """
+        (digest, blob) = self._encode(obj)
+        if digest not in self:
+            data = zlib.compress(blob, self.level)
+            _write_file_atomically(self._loose_path(digest), data)
+        return digest
+
+    def put_many(self, objs, pack=None):
+        """
+        Store each of ``objs``, returning their digests.  New objects are
+        written to a new pack if ``pack`` is True, or if ``pack`` is None and
+        there are at least PACK_THRESHOLD of them; otherwise they're written
+        loose.
+        """
+        digests = []
+        new = dict()
+        for obj in objs:
+            (digest, blob) = self._encode(obj)
+            digests.append(digest)
+            if digest not in new and digest not in self:
+                new[digest] = zlib.compress(blob, self.level)
+
+        if not new:
+            return digests
+
+        if pack is None:
+            pack = len(new) >= PACK_THRESHOLD
+        if pack:
+            self._write_pack(new)
+        else:
+            for (digest, data) in new.items():
+                _write_file_atomically(self._loose_path(digest), data)
+        return digests
+
+    def get_bytes(self, digest):
+        """
+        Return the canonical encoding of the object stored under ``digest``.
+        """
+        try:
+            return zlib.decompress(self._read_compressed(digest))
+        except zlib.error as e:
+            raise CorruptObject("%s: %s" % (digest, e))
+
+    def get(self, digest):
+        return canonical_loads(self.get_bytes(digest))
+
+    def get_many(self, digests):
+        return [ self.get(digest) for digest in digests ]
+
+    def verify(self, digest):
+        """
+        Return True if the object stored under ``digest`` hashes to it.
+        """
+        return hashlib.sha256(self.get_bytes(digest)).hexdigest() == digest
+
+    def pack(self):
+        """
+        Move all loose objects into a new pack.  Returns the number of
+        objects packed.
+        """
+        loose = dict()
+        for (dirpath, _, filenames) in os.walk(self.root):
+            prefix = os.path.basename(dirpath)
+            if len(prefix) != 2 or dirpath == self.packs_dir:
+                continue
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                path = join(dirpath, filename)
+                with open(path, 'rb') as f:
+                    loose[prefix + filename] = (path, f.read())
+
+        if not loose:
+            return 0
+
+        self._write_pack({ d: data for (d, (_, data)) in loose.items() })
+        for (path, _) in loose.values():
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+        return len(loose)
+
+    def close(self):
+        for pack in self.packs.values():
+            pack.close()
+        self.packs.clear()
+
+# vim:set ts=8 sw=4 sts=4 tw=78 et: